@@ -1,95 +1,194 @@
 import glob
-from io import BytesIO
-from operator import attrgetter, itemgetter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from enum import IntEnum
+from functools import lru_cache
+from operator import attrgetter, methodcaller
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from lxml import etree
 import tkinter as tk
 from tkinter import filedialog
 import os
 import re
+import stat
+import tempfile
 from bs4 import BeautifulSoup
 
+class RegionType(IntEnum):
+    UNKNOWN = 0
+    CAPTION = 1
+    CATCH_WORD = 2
+    CREDIT = 3
+    DROP_CAPITAL = 4
+    FLOATING = 5
+    FOOTNOTE = 6
+    HEADER = 7
+    HEADING = 8
+    OTHER = 9
+    PARAGRAPH = 10
+    SIGNATURE_MARK = 11
+    TOC_ENTRY = 12
+
+
+# PAGE-XML region type attribute -> RegionType, anything else is RegionType.UNKNOWN
+REGION_TYPES = {
+    "caption": RegionType.CAPTION,
+    "catch-word": RegionType.CATCH_WORD,
+    "credit": RegionType.CREDIT,
+    "drop-capital": RegionType.DROP_CAPITAL,
+    "floating": RegionType.FLOATING,
+    "footnote": RegionType.FOOTNOTE,
+    "header": RegionType.HEADER,
+    "heading": RegionType.HEADING,
+    "other": RegionType.OTHER,
+    "paragraph": RegionType.PARAGRAPH,
+    "signature-mark": RegionType.SIGNATURE_MARK,
+    "TOC-entry": RegionType.TOC_ENTRY,
+}
+
+UNKNOWN = "WARNING!, the following paragraph couldn't be handled\ncorrectly. You have to solve this by yourself."
+BODY_MARKER = frozenset({RegionType.HEADER, RegionType.HEADING, RegionType.FLOATING, RegionType.CREDIT, RegionType.DROP_CAPITAL})
+
+# Historical letters and spellings that are modernised in the TEI output.
+REPLACEMENTS = (
+    ("ſ", "s"),
+    ("ʒ", "z"),
+    ("Ʒ", "Z"),
+    ("aͤ", "ä"),
+    ("oͤ", "ö"),
+    ("uͤ", "ü"),
+    ("Jch", "Ich"),
+    ("Jtzt", "Itzt"),
+    ("Jst", "Ist"),
+    ("Jn", "In"),
+    ("Jm", "Im"),
+    ("Jhm", "Ihm"),
+    ("Jhn", "Ihn"),
+    ("Jhr", "Ihr"),
+)
+
+
+def normalize_text(text: str) -> str:
+    for old, new in REPLACEMENTS:
+        text = text.replace(old, new)
+    return text
+
+
+class PageXPath:
+    """Compiled XPath expressions and qualified tag names for PAGE-XML files of one namespace."""
+    _PREFIX = "p"
+
+    def __init__(self, namespace: str = None):
+        p = f"{self._PREFIX}:" if namespace else ""
+        ns = {self._PREFIX: namespace} if namespace else None
+        self.text_region_tag = etree.QName(namespace, Page._TEXT_REGION).text
+        self.text_line_tag = etree.QName(namespace, TextRegion._TEXT_LINE).text
+        self.coords_tag = etree.QName(namespace, TextRegion._COORDS).text
+        self.has_text_line = etree.XPath(f"boolean(./{p}{TextRegion._TEXT_LINE})", namespaces=ns)
+        self.text_equiv_indexed = etree.XPath(f"./{p}{TextLine._TEXT_EQUIV}[@{TextLine._INDEX}]", namespaces=ns)
+        self.unicode = etree.XPath(f"./{p}{TextLine._UNICODE}", namespaces=ns)
+
+
+@lru_cache(maxsize=None)
+def page_xpath(namespace: str = None) -> PageXPath:
+    """Return the XPath expressions for `namespace`, compiling them only on first use."""
+    return PageXPath(namespace)
+
 
 class Page:
+    _REGION_REF = "regionRef"
+    _REGION_REF_INDEXED = "RegionRefIndexed"
     _TEXT_REGION = "TextRegion"
+    __slots__ = ("file", "line_height", "reading_order", "text_region_dict", "text_region_list")
 
     def __init__(self, file: str, line_height=50):
         self.file = file
         self.line_height = line_height
-        tree = etree.parse(file)
-        root = tree.getroot()
-        namespace = {"ns": root.nsmap.get(None)}
-
-        self.reading_order = self.parse_reading_order(root, namespace)
-
-        tr = root.findall(f".//{{*}}{self._TEXT_REGION}[{{*}}TextLine]", namespaces=namespace)
-        self.text_region_list = [TextRegion(e, line_height=self.line_height) for e in tr]
-        self.text_region_dict = {tr.text_region.get('id'): tr for tr in self.text_region_list}
+        self.reading_order: List[str] = []
+        self.text_region_dict: Dict[str, "TextRegion"] = {}
+
+        # Stream the file and prune every handled element, so only the region
+        # currently being read is kept in memory instead of the whole DOM.
+        tags = (f"{{*}}{self._REGION_REF_INDEXED}", f"{{*}}{self._TEXT_REGION}")
+        xpath = None
+        for _, element in etree.iterparse(file, events=("end",), tag=tags):
+            if xpath is None:
+                # A PAGE file uses one namespace throughout, so it is resolved only once.
+                xpath = page_xpath(etree.QName(element).namespace)
+            if element.tag == xpath.text_region_tag:
+                if xpath.has_text_line(element):
+                    text_region = TextRegion(element, line_height=self.line_height, xpath=xpath)
+                    self.text_region_dict[text_region.id] = text_region
+            else:
+                self.reading_order.append(element.get(self._REGION_REF))
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
 
         self.sort_text_region()
 
     def __repr__(self) -> str:
         return self.file
 
-    def parse_reading_order(self, root, namespace) -> List[str]:
-        reading_order_elements = root.findall(f".//{{*}}OrderedGroup//{{*}}RegionRefIndexed", namespaces=namespace)
-        reading_order = [el.get("regionRef") for el in reading_order_elements]
-        return reading_order
-
     def sort_text_region(self) -> None:
-        if not self.text_region_dict:
+        # The dict keeps document order, which usually is the reading order already.
+        if self.reading_order == list(self.text_region_dict):
+            self.text_region_list = list(self.text_region_dict.values())
             return
         ordered_text_regions = [self.text_region_dict[region_id] for region_id in self.reading_order if region_id in self.text_region_dict]
-        self.text_region_list = ordered_text_regions
+        self.text_region_list = ordered_text_regions or list(self.text_region_dict.values())
 
 
 class TextRegion:
     _COORDS = "Coords"
-    _GLYPH = "Glyph"
     _ID = "id"
     _TEXT_LINE = "TextLine"
     _POINTS = "points"
-    _WORD = "Word"
+    __slots__ = ("id", "type", "type_name", "line_height", "line", "text", "x", "y", "horizontal_group")
 
-    def __init__(self, text_region: etree._Element, line_height: int = 50):
+    def __init__(self, text_region: etree._Element, line_height: int = 50, xpath: PageXPath = None):
         if line_height < 0:
             raise ValueError("line_height need to be positive")
-        self.text_region = text_region
-        self.type = text_region.get("type")
+        # Only plain values are kept, the element itself is not referenced
+        # after __init__ so the parsed page can be freed.
+        self.id = text_region.get(self._ID)
+        self.type_name = text_region.get("type")
+        self.type = REGION_TYPES.get(self.type_name, RegionType.UNKNOWN)
         self.line_height = line_height
-        self.line: List["TextLine"] = self.get_lines()
+        self.line: List["TextLine"] = self.get_lines(text_region, xpath or page_xpath(etree.QName(text_region).namespace))
+        if len(self.line) == 1:
+            self.text = self.line[0].get_text()
+        else:
+            self.text = "\n".join(filter(None, (ln.get_text() for ln in self.line)))
         self.x = self.line[0].x
         self.y = self.line[0].y
 
-    def convert_coordinates(self, points: str) -> List[Tuple[int, int]]:
-        result = []
-        for p in points.split(' '):
-            x, y = p.split(',')
-            result.append((int(x), int(y)))
-        return result
-
-    def get_reference_point(self, points: List[Tuple[int, int]]) -> Tuple[int, int]:
-        reference_point = sorted(points, key=itemgetter(1, 0))[0]
-        return reference_point
-
-    def get_lines(self) -> List["TextLine"]:
-        text_line = self.text_region.findall(f".//{{*}}{self._TEXT_LINE}")
+    def get_reference_point(self, points: str) -> Tuple[int, int]:
+        # Topmost point of the "x,y x,y ..." polygon, the leftmost one if several share that y.
+        values = list(map(int, points.replace(',', ' ').split()))
+        xs, ys = values[::2], values[1::2]
+        y = min(ys)
+        if ys.count(y) == 1:
+            return xs[ys.index(y)], y
+        return min(x for x, y_ in zip(xs, ys) if y_ == y), y
+
+    def get_lines(self, text_region: etree._Element, xpath: PageXPath) -> List["TextLine"]:
+        text_line = text_region.iterchildren(xpath.text_line_tag)
         lines = []
 
         for line in text_line:
-            coords_element = line.find(f"./{{*}}{self._COORDS}")
+            coords_element = next(line.iterchildren(xpath.coords_tag), None)
             if coords_element is None:
-                print(f"Warning: Missing Coords for TextLine in region {self.text_region.get('id')}")
+                print(f"Warning: Missing Coords for TextLine in region {self.id}")
                 continue  # Überspringe diese Zeile
             points = coords_element.get(self._POINTS)
             if points is None:
-                print(f"Warning: Missing points attribute in Coords for TextLine in region {self.text_region.get('id')}")
+                print(f"Warning: Missing points attribute in Coords for TextLine in region {self.id}")
                 continue  # Überspringe diese Zeile
 
-            reference_point = self.convert_coordinates(points)
-            reference_point = self.get_reference_point(reference_point)
-            lines.append(TextLine(line, reference_point))
+            reference_point = self.get_reference_point(points)
+            lines.append(TextLine(line, reference_point, xpath))
 
         lines.sort(key=attrgetter("y"))
         return lines
@@ -100,52 +199,71 @@ class TextRegion:
 
     def __str__(self):
         lines_text = "\n".join([str(line) for line in self.line])
-        return f"type={self.type}\n{lines_text}\n])"
+        return f"type={self.type_name}\n{lines_text}\n])"
 
 
 class TextLine:
     _INDEX = "index"
     _TEXT_EQUIV = "TextEquiv"
     _UNICODE = "Unicode"
+    __slots__ = ("x", "y", "_text")
 
-    def __init__(self, text_line: etree._Element, reference_point: Tuple[int, int]):
-        self.text_line = text_line
+    def __init__(self, text_line: etree._Element, reference_point: Tuple[int, int], xpath: PageXPath = None):
         self.x, self.y = reference_point
+        self._text = self.read_text(text_line, xpath or page_xpath(etree.QName(text_line).namespace))
 
-    def get_text(self) -> str:
-        te = self.text_line.findall(f"./{{*}}{self._TEXT_EQUIV}[@{self._INDEX}]")
-        text_equiv = [[e.get(self._INDEX), e.find(f"./{{*}}{self._UNICODE}").text] for e in te]
-        text_equiv.sort(key=itemgetter(0))
-        try:
-            return text_equiv[0][1]
-        except IndexError:
+    def read_text(self, text_line: etree._Element, xpath: PageXPath) -> str:
+        te = xpath.text_equiv_indexed(text_line)
+        text_equiv = min(te, key=methodcaller("get", self._INDEX), default=None)
+        if text_equiv is None:
             return ""
+        unicode = xpath.unicode(text_equiv)
+        return normalize_text((unicode[0].text if unicode else None) or "")
+
+    def get_text(self) -> str:
+        return self._text
 
     def __str__(self):
         text = self.get_text()
         return f"{text}\nTextLine(x={self.x}, y={self.y})"
 
 
+def parse_page(path: str) -> Page:
+    """Parse `path` in a worker process, a failure is returned as a picklable RuntimeError.
+
+    lxml's parse errors can't be sent back from the worker, and a raised error would
+    surface at the first page of its chunk instead of at the page that failed.
+    """
+    try:
+        return Page(path)
+    except Exception as e:
+        return RuntimeError(str(e))
+
+
 class Conversion:
     _FRONT = "front"
     _BODY = "body"
     _SPLIT = " .,"
+    _PROLOG = (b'<?xml version="1.0" encoding="utf-8"?>\n'
+               b'<?xml-stylesheet type="text/css" href="../css/tei.css"?>\n'
+               b'<?xml-model href="https://dracor.org/schema.rng" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"?>\n')
 
     def __init__(self, folder: str = None):
         if folder:
             self.file_list = glob.glob(folder)
             self.file_list.sort()
-            self.file_iter = iter(self.file_list)
-            self.current_file = next(self.file_iter, "end")
-            self.page = Page(self.current_file)
             self._text_part = self._FRONT
+        self.pages = iter(())
+        self.file_iter = iter(())
+        self.current_file = None
+        self.page = None
         self.__previous_type = None
         self.__front = None
         self.__title_page = None
         self.__is_title_page_created = False
         self.__div_preface = None
         self.__prologue = None
-        self.__act = None
+        self.__act: ExitStack = None  # holds the open <div type="act"> of the xmlfile
         self.__scene = None
         self.__stage = None
         self.__cast_list = None
@@ -153,8 +271,29 @@ class Conversion:
         self.__sp_grp = None
         self.__sp = None
         self.__set = None
-
-    def create_tei(self, file: str):
+        self._front_handlers = {
+            RegionType.CATCH_WORD: self._front_catch_word,
+            RegionType.OTHER: self._front_other,
+            RegionType.TOC_ENTRY: self._front_toc_entry,
+            RegionType.SIGNATURE_MARK: self._front_signature_mark,
+            RegionType.FOOTNOTE: self._front_footnote,
+        }
+        self._body_handlers = {
+            RegionType.HEADER: self._body_header,
+            RegionType.HEADING: self._body_heading,
+            RegionType.TOC_ENTRY: self._body_toc_entry,
+            RegionType.SIGNATURE_MARK: self._body_signature_mark,
+            RegionType.FLOATING: self._body_floating,
+            RegionType.CREDIT: self._body_speaker,
+            RegionType.DROP_CAPITAL: self._body_speaker,
+            RegionType.PARAGRAPH: self._body_paragraph,
+            RegionType.CAPTION: self._body_caption,
+            RegionType.FOOTNOTE: self._body_footnote,
+            RegionType.CATCH_WORD: self._body_catch_word,
+        }
+
+    def create_tei(self, file: str) -> bool:
+        """Write the TEI to `file`, return False if the conversion failed and nothing was written."""
 
         metadata_file = Path(self.file_list[0]).parent / "metadata.txt"
 
@@ -170,59 +309,61 @@ class Conversion:
                     key, *value = line.split(": ", 1)
                     key = key.strip()
                     value = value[0].strip() if value else ""
-                    user_data[key] = value
+                    user_data[key] = normalize_text(value)
         else:
             print("Error: 'metadata.txt' not found. Exiting.")
-            return
+            return False
 
         WRONG = ""
-        BODY_MARKER = ["header", "heading", "floating", "credit", "drop-capital"]
-
-        root = etree.Element("TEI", attrib={"xmlns": "http://www.tei-c.org/ns/1.0", "{http://www.w3.org/XML/1998/namespace}id": "ger000", "{http://www.w3.org/XML/1998/namespace}lang": "de"})
-        tree = etree.ElementTree(root)
-        pi1 = etree.ProcessingInstruction("xml-stylesheet", 'type="text/css" href="../css/tei.css"')
-        pi2 = etree.ProcessingInstruction("xml-model", 'href="https://dracor.org/schema.rng" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"')
-        tree.getroot().addprevious(pi1)
-        tree.getroot().addprevious(pi2)
 
-        f = BytesIO()
         act_number = 0
+        # Pages don't depend on each other, so they are parsed in worker
+        # processes while the TEI is written in order from their results.
+        executor = None
+        # The TEI is streamed into a temporary file that only replaces `file`
+        # once the whole conversion succeeded, so no truncated output is left.
+        tmp_file = None
         try:
-            with etree.xmlfile(f, encoding="utf-8") as xf:
-                xf.write(pi1)
-                xf.write(pi2)
-                with xf.element("TEI", xmlns="http://www.tei-c.org/ns/1.0", attrib={"xml:id": "ger000", "xml:lang": "de"}):
-                    with xf.element("teiHeader"):
-                        with xf.element("fileDesc"):
-                            with xf.element("titleStmt"):
-                                with xf.element("title", type="main"):
-                                    xf.write(user_data.get("mainTitle", ""))
-                                with xf.element("title", type="sub"):
-                                    xf.write(user_data.get("subTitle", ""))
-                                with xf.element("author"):
-                                    with xf.element("persName"):
-                                        with xf.element("forename"):
-                                            xf.write(user_data.get("authorForename", ""))
-                                        with xf.element("nameLink"):
-                                            xf.write(user_data.get("nameLink", ""))
-                                        with xf.element("surname"):
-                                            xf.write(user_data.get("authorSurname", ""))
-                                    with xf.element("idno", type="wikidata"):
-                                        xf.write(user_data.get("wikidata", ""))
-                                    with xf.element("idno", type="pnd"):
-                                        xf.write(user_data.get("pnd", ""))
-                            with xf.element("publicationStmt"):
-                                with xf.element("publisher"):
-                                    xf.write(WRONG)
-                            with xf.element("sourceDesc"):
-                                with xf.element("bibl", type="digitalSource"):
-                                    with xf.element("name"):
+            executor = ProcessPoolExecutor()
+            self.pages = executor.map(parse_page, self.file_list, chunksize=8)
+            self.file_iter = iter(self.file_list)
+            self.next_page()
+            tmp_file = tempfile.NamedTemporaryFile(dir=Path(file).parent, prefix=f".{Path(file).name}.", suffix=".tmp", delete=False)
+            with tmp_file as f:
+                f.write(self._PROLOG)
+                with etree.xmlfile(f, encoding="utf-8") as xf:
+                    with xf.element("TEI", xmlns="http://www.tei-c.org/ns/1.0", attrib={"xml:id": "ger000", "xml:lang": "de"}):
+                        with xf.element("teiHeader"):
+                            with xf.element("fileDesc"):
+                                with xf.element("titleStmt"):
+                                    with xf.element("title", type="main"):
+                                        xf.write(user_data.get("mainTitle", ""))
+                                    with xf.element("title", type="sub"):
+                                        xf.write(user_data.get("subTitle", ""))
+                                    with xf.element("author"):
+                                        with xf.element("persName"):
+                                            with xf.element("forename"):
+                                                xf.write(user_data.get("authorForename", ""))
+                                            with xf.element("nameLink"):
+                                                xf.write(user_data.get("nameLink", ""))
+                                            with xf.element("surname"):
+                                                xf.write(user_data.get("authorSurname", ""))
+                                        with xf.element("idno", type="wikidata"):
+                                            xf.write(user_data.get("wikidata", ""))
+                                        with xf.element("idno", type="pnd"):
+                                            xf.write(user_data.get("pnd", ""))
+                                with xf.element("publicationStmt"):
+                                    with xf.element("publisher"):
                                         xf.write(WRONG)
-                                    with xf.element("idno", type="URL"):
-                                        xf.write(user_data.get("url", ""))
-                                    with xf.element("bibl", type="originalSource"):
-                                        with xf.element("title"):
-                                            xf.write(f"""{user_data.get("authorForename", "")} 
+                                with xf.element("sourceDesc"):
+                                    with xf.element("bibl", type="digitalSource"):
+                                        with xf.element("name"):
+                                            xf.write(WRONG)
+                                        with xf.element("idno", type="URL"):
+                                            xf.write(user_data.get("url", ""))
+                                        with xf.element("bibl", type="originalSource"):
+                                            with xf.element("title"):
+                                                xf.write(f"""{user_data.get("authorForename", "")} 
                                                          {user_data.get("nameLink", "")} 
                                                          {user_data.get("authorSurname", "")}{":" if user_data.get("authorSurname", "") else " "}
                                                          {user_data.get("mainTitle", "")}{". " if user_data.get("mainTitle", "") else " "}
@@ -232,131 +373,135 @@ class Conversion:
                                                          {user_data.get("date", "")}{". " if user_data.get("date", "") else " "}
                                                     """)
                                                      
-                    with xf.element("text"):
-                        if self.page.text_region_list[0].type in BODY_MARKER:
-                            self._text_part = self._BODY
-                        if self._text_part == self._FRONT:
-                            self.__front = etree.Element("front")
-                            while self._text_part == self._FRONT:
-                                for text_region in self.page.text_region_list:
-                                    if text_region.type in BODY_MARKER:
-                                        self.write_front(xf)
-                                        break
-                                    try:
-                                        self.build_front(text_region)
-                                    except Exception as e:
-                                        lines_text = "\n".join([line.get_text() for line in text_region.line])
-                                        print(f"\nERROR for type={text_region.type} in {os.path.basename(self.current_file)}\n\n{lines_text}\n\n####################################################\n")
-                                if text_region is self.page.text_region_list[-1]:
-                                    self.current_file = next(self.file_iter, "end")
-                                    if self.current_file != "end":
-                                        self.page = Page(self.current_file)
-                                if self.page.text_region_list[0].type in BODY_MARKER:
-                                    self.write_front(xf)
-                                    break
-
-                        if self._text_part == self._BODY:
-                            with xf.element("body"):
-                                while self.current_file != "end":
+                        with xf.element("text"):
+                            if self.page.text_region_list[0].type in BODY_MARKER:
+                                self._text_part = self._BODY
+                            if self._text_part == self._FRONT:
+                                self.__front = etree.Element("front")
+                                while self._text_part == self._FRONT:
                                     for text_region in self.page.text_region_list:
+                                        if text_region.type in BODY_MARKER:
+                                            self.write_front(xf)
+                                            break
                                         try:
-                                            act_number = self.build_body(xf, text_region, act_number)
+                                            self.build_front(text_region)
                                         except Exception as e:
                                             lines_text = "\n".join([line.get_text() for line in text_region.line])
-                                            print(f"\nERROR for type={text_region.type} in {os.path.basename(self.current_file)}\n\n{lines_text}\n\n####################################################\n")
+                                            print(f"\nERROR for type={text_region.type_name} in {os.path.basename(self.current_file)}\n\n{lines_text}\n\n####################################################\n")
                                     if text_region is self.page.text_region_list[-1]:
-                                        self.current_file = next(self.file_iter, "end")
-                                        if self.current_file != "end":
-                                            self.page = Page(self.current_file)
-
-            result = f.getvalue().decode("utf-8")
-
-            result = result.replace("ſ", "s")
-            result = result.replace("ʒ", "z")
-            result = result.replace("Ʒ", "Z")
-            result = result.replace("aͤ", "ä")
-            result = result.replace("oͤ", "ö")
-            result = result.replace("uͤ", "ü")
-            result = result.replace("Jch", "Ich")
-            result = result.replace("Jtzt", "Itzt")
-            result = result.replace("Jst", "Ist")
-            result = result.replace("Jn", "In")
-            result = result.replace("Jm", "Im")
-            result = result.replace("Jhm", "Ihm")
-            result = result.replace("Jhn", "Ihn")
-            result = result.replace("Jhr", "Ihr")
-
-            with open(file, "w", encoding="utf-8") as f:
-                prolog = """<?xml version="1.0" encoding="utf-8"?>
-                            <?xml-stylesheet type="text/css" href="../css/tei.css"?>
-                            <?xml-model href="https://dracor.org/schema.rng" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"?>"""
-                result = prolog + result
-                f.write(result)
+                                        self.next_page()
+                                    if self.page.text_region_list[0].type in BODY_MARKER:
+                                        self.write_front(xf)
+                                        break
+
+                            if self._text_part == self._BODY:
+                                with xf.element("body"):
+                                    try:
+                                        while self.current_file != "end":
+                                            for text_region in self.page.text_region_list:
+                                                try:
+                                                    act_number = self.build_body(xf, text_region, act_number)
+                                                except Exception as e:
+                                                    lines_text = "\n".join([line.get_text() for line in text_region.line])
+                                                    print(f"\nERROR for type={text_region.type_name} in {os.path.basename(self.current_file)}\n\n{lines_text}\n\n####################################################\n")
+                                            self.next_page()
+                                    finally:
+                                        # close the last act even if a page failed, so the
+                                        # xmlfile contexts stay balanced and the real error surfaces
+                                        self.close_act(xf)
+
+            # temporary files are owner-only, give it the mode `file` has or would get from plain open()
+            if os.path.exists(file):
+                mode = stat.S_IMODE(os.stat(file).st_mode)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(tmp_file.name, mode)
+            os.replace(tmp_file.name, file)
             print(f"{Path(file).name} edited")
+            return True
         except Exception as e:
             print(f"{self.current_file} <--- ERROR: {e}\nfile may not contain relevant content. Remove file from folder.\n------------------------------\n")
+            return False
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            if tmp_file is not None and os.path.exists(tmp_file.name):
+                os.remove(tmp_file.name)
+
+    def next_page(self) -> None:
+        """Advance to the next parsed page, `current_file` becomes "end" after the last one."""
+        # name the file before its result is pulled, so a failing page is reported as itself
+        self.current_file = next(self.file_iter, "end")
+        if self.current_file != "end":
+            self.page = next(self.pages)
+            if isinstance(self.page, Exception):
+                raise self.page
 
     def build_front(self, text_region: "TextRegion") -> None:
-        UNKNOWN = "WARNING!, the following paragraph couldn't be handled\ncorrectly. You have to solve this by yourself."
-
-        if self.__previous_type in ["signature-mark", "TOC-Entry"] and text_region.type == "catch-word":
+        if self.__previous_type == RegionType.SIGNATURE_MARK and text_region.type == RegionType.CATCH_WORD:
             self.__is_title_page_created = True
 
-        if text_region.type == "catch-word":
-            if self.__is_title_page_created:
-                self.__div_preface = etree.SubElement(self.__front, "div", type="preface")
-                p = etree.SubElement(self.__div_preface, "p")
-                p.text = "WARNING!, the following 'head' might be slightly misplaced. Maybe\nthere is a more suitable parent tag or it might be another title page."
-                head = etree.SubElement(self.__div_preface, "head")
-                head.text = self.concatenate_lines(text_region)
-            else:
-                if self.__previous_type != "catch-word":
-                    self.__title_page = etree.SubElement(self.__front, "titlePage")
-                    title_part = etree.SubElement(self.__title_page, "titlePart")
-                    title_part.text = "WARNING!, it's just assumed that this is the title page, check\nthis. Also check if the following 'head' elements in 'front' may be (another)\ntitle page."
-                title_part = etree.SubElement(self.__title_page, "titlePart")
-                title_part.text = self.concatenate_lines(text_region)
+        handler = self._front_handlers.get(text_region.type, self._front_unknown)
+        handler(text_region)
+
+        self.__previous_type = text_region.type
 
-        elif text_region.type == "other":
-            if self.__previous_type not in ["other", "catch-word"] or self.__div_preface is None:
-                self.__div_preface = etree.SubElement(self.__front, "div", type="preface")
+    def _front_catch_word(self, text_region: "TextRegion") -> None:
+        if self.__is_title_page_created:
+            self.__div_preface = etree.SubElement(self.__front, "div", type="preface")
             p = etree.SubElement(self.__div_preface, "p")
-            p.text = self.concatenate_lines(text_region)
-
-        elif text_region.type == "TOC-entry":
-            if not (self.__previous_type == "TOC-entry" or self.__previous_type == "signature-mark") or self.__cast_list is None:
-                self.__cast_list = etree.SubElement(self.__front, "castList")
-            self.__cast_item = etree.SubElement(self.__cast_list, "castItem")
-            role = etree.SubElement(self.__cast_item, "role")
-            role.text = self.concatenate_lines(text_region)
-
-        elif text_region.type == "signature-mark":
-            if self.__cast_item is None:
-                cast_list_replace = etree.SubElement(self.__front, "castList")
-                cast_item_replace = etree.SubElement(cast_list_replace, "castItem")
-                role = etree.SubElement(cast_item_replace, "role")
-                role.text = "WARNING!, it seems that the role is missing. You should fix this."
-                role_desc = etree.SubElement(cast_item_replace, "roleDesc")
-            else:
-                role_desc = etree.SubElement(self.__cast_item, "roleDesc")
-            role_desc.text = self.concatenate_lines(text_region)
-
-        elif text_region.type == "footnote":
-            user_note = etree.SubElement(self.__front, "div", type="notes")
-            p = etree.SubElement(user_note, "p")
-            p.text = "WARNING!, this footnote couldn't be placed correctly, you have to\nsolve this by yourself."
-            footnote = etree.SubElement(user_note, "note", place="foot")
-            footnote.text = self.concatenate_lines(text_region)
+            p.text = "WARNING!, the following 'head' might be slightly misplaced. Maybe\nthere is a more suitable parent tag or it might be another title page."
+            head = etree.SubElement(self.__div_preface, "head")
+            head.text = text_region.text
         else:
-            unknown = etree.SubElement(self.__front, "div", type="notes")
-            type_ = "type = " + text_region.type
-            content = self.concatenate_lines(text_region)
-            p_list = [UNKNOWN, type_, content]
-            for e in p_list:
-                p = etree.SubElement(unknown, "p")
-                p.text = e
-
-        self.__previous_type = text_region.type
+            if self.__previous_type != RegionType.CATCH_WORD:
+                self.__title_page = etree.SubElement(self.__front, "titlePage")
+                title_part = etree.SubElement(self.__title_page, "titlePart")
+                title_part.text = "WARNING!, it's just assumed that this is the title page, check\nthis. Also check if the following 'head' elements in 'front' may be (another)\ntitle page."
+            title_part = etree.SubElement(self.__title_page, "titlePart")
+            title_part.text = text_region.text
+
+    def _front_other(self, text_region: "TextRegion") -> None:
+        if self.__previous_type not in (RegionType.OTHER, RegionType.CATCH_WORD) or self.__div_preface is None:
+            self.__div_preface = etree.SubElement(self.__front, "div", type="preface")
+        p = etree.SubElement(self.__div_preface, "p")
+        p.text = text_region.text
+
+    def _front_toc_entry(self, text_region: "TextRegion") -> None:
+        if self.__previous_type not in (RegionType.TOC_ENTRY, RegionType.SIGNATURE_MARK) or self.__cast_list is None:
+            self.__cast_list = etree.SubElement(self.__front, "castList")
+        self.__cast_item = etree.SubElement(self.__cast_list, "castItem")
+        role = etree.SubElement(self.__cast_item, "role")
+        role.text = text_region.text
+
+    def _front_signature_mark(self, text_region: "TextRegion") -> None:
+        if self.__cast_item is None:
+            cast_list_replace = etree.SubElement(self.__front, "castList")
+            cast_item_replace = etree.SubElement(cast_list_replace, "castItem")
+            role = etree.SubElement(cast_item_replace, "role")
+            role.text = "WARNING!, it seems that the role is missing. You should fix this."
+            role_desc = etree.SubElement(cast_item_replace, "roleDesc")
+        else:
+            role_desc = etree.SubElement(self.__cast_item, "roleDesc")
+        role_desc.text = text_region.text
+
+    def _front_footnote(self, text_region: "TextRegion") -> None:
+        user_note = etree.SubElement(self.__front, "div", type="notes")
+        p = etree.SubElement(user_note, "p")
+        p.text = "WARNING!, this footnote couldn't be placed correctly, you have to\nsolve this by yourself."
+        footnote = etree.SubElement(user_note, "note", place="foot")
+        footnote.text = text_region.text
+
+    def _front_unknown(self, text_region: "TextRegion") -> None:
+        unknown = etree.SubElement(self.__front, "div", type="notes")
+        type_ = "type = " + text_region.type_name
+        content = text_region.text
+        p_list = [UNKNOWN, type_, content]
+        for e in p_list:
+            p = etree.SubElement(unknown, "p")
+            p.text = e
 
     def write_front(self, xf: "etree"):
         set_ = etree.SubElement(self.__front, "set")
@@ -366,144 +511,171 @@ class Conversion:
         self._text_part = self._BODY
 
     def build_body(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
-        UNKNOWN = "WARNING!, the following paragraph couldn't be handled\ncorrectly. You have to solve this by yourself."
-
         try:
-
-            if text_region.type == "header":
-                if etree.iselement(self.__prologue):
-                    xf.write(self.__prologue)
-                    self.__prologue = None
-                act_number += 1
-                if act_number > 1:
-                    xf.write(self.__act)
-                self.__act = etree.Element("div", type="act")
-                head = etree.SubElement(self.__act, "head")
-                head.text = self.concatenate_lines(text_region)
-
-            elif text_region.type == "heading":
-                if self.__act is None:
-                    if etree.iselement(self.__prologue):
-                        xf.write(self.__prologue)
-                    self.__prologue = etree.Element("div", type="prologue")
-                    head = etree.SubElement(self.__prologue, "head")
-                    head.text = self.concatenate_lines(text_region)
-                else:
-                    self.__scene = etree.SubElement(self.__act, "div", type="scene")
-                    head = etree.SubElement(self.__scene, "head")
-                    head.text = self.concatenate_lines(text_region)
-                    stage = etree.SubElement(self.__scene, "stage")
-                    #self.__cast_list = etree.SubElement(stage, "castList")
-                print("Initialized scene:", self.__scene)  # Debugging-Statement
-
-            elif text_region.type == "TOC-entry":
-                cast_item = etree.SubElement(self.__scene, "stage")
-                cast_item.text = self.concatenate_lines(text_region)
-
-            elif text_region.type == "signature-mark":
-                if etree.iselement(self.__prologue):
-                    stage = etree.SubElement(self.__prologue, "stage")
-                elif self.__previous_type == "header":
-                    stage = etree.SubElement(self.__act, "stage")
-                else:
-                    stage = etree.SubElement(self.__scene, "stage")
-                stage.text = self.concatenate_lines(text_region)
-
-            elif text_region.type == "floating":
-                if etree.iselement(self.__prologue):
-                    self.__sp_grp = etree.SubElement(self.__prologue, "spGrp")
-                else:
-                    self.__sp_grp = etree.SubElement(self.__scene, "spGrp")
-                head = etree.SubElement(self.__sp_grp, "head")
-                head.text = self.concatenate_lines(text_region)
-                sp = etree.SubElement(self.__sp_grp, "sp")
-                speaker = etree.SubElement(sp, "speaker")
-                speaker.text = "WARNING!"
-                p = etree.SubElement(sp, "p")
-                p.text = "WARNING! Place the closing 'spGrp' tag after the last 'sp' tag of the\nsinging."
-
-            elif text_region.type in ["credit", "drop-capital"]:
-                if etree.iselement(self.__prologue):
-                    self.__sp = etree.SubElement(self.__prologue, "sp")
-                else:
-                    if self.__scene is None:
-                        # Falls die Szene nicht initialisiert wurde
-                        print("Error: Scene not initialized")
-                        self.__scene = etree.SubElement(self.__act, "div", type="scene")
-                        print("Initialized scene in fallback")
-                    self.__sp = etree.SubElement(self.__scene, "sp")
-                speaker = etree.SubElement(self.__sp, "speaker")
-                speaker.text = self.concatenate_lines(text_region)
-
-            elif text_region.type == "paragraph":
-                if self.__sp is None:
-                    self.__sp = etree.SubElement(self.__scene, "sp")
-                    speaker = etree.SubElement(self.__sp, "speaker")
-                    speaker.text = "WARNING!, it seems that the speaker is missing."
-
-                for l_element in self.concatenate_l_lines(text_region):
-                    self.__sp.append(l_element)
-                
-            elif text_region.type == "caption":
-                if self.__sp is None:
-                    self.__sp = etree.SubElement(self.__scene, "sp")
-                    speaker = etree.SubElement(self.__sp, "speaker")
-                    speaker.text = "WARNING!, it seems that the speaker is missing."                    
-                stage = etree.SubElement(self.__sp, "stage")
-                stage.text = self.concatenate_lines(text_region)
-
-            elif text_region.type == "footnote":
-                if etree.iselement(self.__prologue):
-                    user_note = etree.SubElement(self.__prologue, "div", type="notes")
-                else:
-                    user_note = etree.SubElement(self.__scene, "div", type="notes")
-                p = etree.SubElement(user_note, "p")
-                p.text = "WARNING!, this footnote couldn't be placed correctly, you have to\nsolve this by yourself. Source file: " + self.current_file.split("/")[-1]
-                footnote = etree.SubElement(user_note, "note", place="foot")
-                footnote.text = self.concatenate_lines(text_region)
-
-            elif text_region.type == "catch-word":
-                if self.__scene is None:
-                    p = etree.Element("p")
-                    p.text = "WARNING!, the following 'head' element might be misplaced, i.e.\nthere could be a better place."
-                    caption = etree.Element("head")
-                    caption.text = self.concatenate_lines(text_region)
-                    xf.write(p)
-                    xf.write(caption)
-                else:
-                    caption = etree.SubElement(self.__scene, "div", type="notes")
-                    message = "WARNING!, the element isn't placed correctly, it still needs a solution."
-                    type_ = "type = " + text_region.type
-                    content = self.concatenate_lines(text_region)
-                    p_text = [message, type_, content]
-                    for text in p_text:
-                        p = etree.SubElement(caption, "p")
-                        p.text = text
-
-            else:
-                if etree.iselement(self.__prologue):
-                    unknown = etree.SubElement(self.__scene, "div", type="notes")
-                else:
-                    unknown = etree.SubElement(self.__scene, "div", type="notes")
-                type_ = "type = " + text_region.type
-                content = self.concatenate_lines(text_region)
-                p_list = [UNKNOWN, type_, content]
-                for e in p_list:
-                    p = etree.SubElement(unknown, "p")
-                    p.text = e
-            if self.current_file is self.file_list[-1] and text_region is self.page.text_region_list[-1]:
-                xf.write(self.__act)
+            handler = self._body_handlers.get(text_region.type, self._body_unknown)
+            act_number = handler(xf, text_region, act_number)
             self.__previous_type = text_region.type
 
         except Exception as e:
-            print(f"Error processing region {text_region.text_region.get('id')}, type={text_region.type}: {e}")
+            print(f"Error processing region {text_region.id}, type={text_region.type_name}: {e}")
             raise
         
         return act_number
-    
-    def concatenate_lines(self, text_region: "TextRegion") -> str:
-        text = [ln.get_text() for ln in text_region.line]
-        return "\n".join(filter(None, text))
+
+    def start_scene(self, xf: "etree") -> etree._Element:
+        """Write the finished scene and start a new one in the open act."""
+        if self.__act is None:
+            raise ValueError("there is no act to place the scene in")
+        if self.__scene is not None:
+            xf.write(self.__scene)
+        self.__scene = etree.Element("div", type="scene")
+        self.__sp = None
+        return self.__scene
+
+    def close_act(self, xf: "etree") -> None:
+        """Write the pending scene and close the open act."""
+        if self.__scene is not None:
+            xf.write(self.__scene)
+            self.__scene = None
+            self.__sp = None
+        if self.__act is not None:
+            self.__act.close()
+            self.__act = None
+
+    def _body_header(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__prologue is not None:
+            xf.write(self.__prologue)
+            self.__prologue = None
+        act_number += 1
+        self.close_act(xf)
+        self.__act = ExitStack()
+        self.__act.enter_context(xf.element("div", type="act"))
+        head = etree.Element("head")
+        head.text = text_region.text
+        xf.write(head)
+        return act_number
+
+    def _body_heading(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__act is None:
+            if self.__prologue is not None:
+                xf.write(self.__prologue)
+            self.__prologue = etree.Element("div", type="prologue")
+            head = etree.SubElement(self.__prologue, "head")
+            head.text = text_region.text
+        else:
+            self.start_scene(xf)
+            head = etree.SubElement(self.__scene, "head")
+            head.text = text_region.text
+            stage = etree.SubElement(self.__scene, "stage")
+            #self.__cast_list = etree.SubElement(stage, "castList")
+        print("Initialized scene:", self.__scene)  # Debugging-Statement
+        return act_number
+
+    def _body_toc_entry(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        cast_item = etree.SubElement(self.__scene, "stage")
+        cast_item.text = text_region.text
+        return act_number
+
+    def _body_signature_mark(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__prologue is not None:
+            stage = etree.SubElement(self.__prologue, "stage")
+        elif self.__previous_type == RegionType.HEADER:
+            stage = etree.Element("stage")
+        else:
+            stage = etree.SubElement(self.__scene, "stage")
+        stage.text = text_region.text
+        if stage.getparent() is None:
+            xf.write(stage)
+        return act_number
+
+    def _body_floating(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__prologue is not None:
+            self.__sp_grp = etree.SubElement(self.__prologue, "spGrp")
+        else:
+            self.__sp_grp = etree.SubElement(self.__scene, "spGrp")
+        head = etree.SubElement(self.__sp_grp, "head")
+        head.text = text_region.text
+        sp = etree.SubElement(self.__sp_grp, "sp")
+        speaker = etree.SubElement(sp, "speaker")
+        speaker.text = "WARNING!"
+        p = etree.SubElement(sp, "p")
+        p.text = "WARNING! Place the closing 'spGrp' tag after the last 'sp' tag of the\nsinging."
+        return act_number
+
+    def _body_speaker(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__prologue is not None:
+            self.__sp = etree.SubElement(self.__prologue, "sp")
+        else:
+            if self.__scene is None:
+                # Falls die Szene nicht initialisiert wurde
+                print("Error: Scene not initialized")
+                self.start_scene(xf)
+                print("Initialized scene in fallback")
+            self.__sp = etree.SubElement(self.__scene, "sp")
+        speaker = etree.SubElement(self.__sp, "speaker")
+        speaker.text = text_region.text
+        return act_number
+
+    def _body_paragraph(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__sp is None:
+            self.__sp = etree.SubElement(self.__scene, "sp")
+            speaker = etree.SubElement(self.__sp, "speaker")
+            speaker.text = "WARNING!, it seems that the speaker is missing."
+        for l_element in self.concatenate_l_lines(text_region):
+            self.__sp.append(l_element)
+        return act_number
+
+    def _body_caption(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__sp is None:
+            self.__sp = etree.SubElement(self.__scene, "sp")
+            speaker = etree.SubElement(self.__sp, "speaker")
+            speaker.text = "WARNING!, it seems that the speaker is missing."
+        stage = etree.SubElement(self.__sp, "stage")
+        stage.text = text_region.text
+        return act_number
+
+    def _body_footnote(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__prologue is not None:
+            user_note = etree.SubElement(self.__prologue, "div", type="notes")
+        else:
+            user_note = etree.SubElement(self.__scene, "div", type="notes")
+        p = etree.SubElement(user_note, "p")
+        p.text = "WARNING!, this footnote couldn't be placed correctly, you have to\nsolve this by yourself. Source file: " + self.current_file.split("/")[-1]
+        footnote = etree.SubElement(user_note, "note", place="foot")
+        footnote.text = text_region.text
+        return act_number
+
+    def _body_catch_word(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__scene is None:
+            p = etree.Element("p")
+            p.text = "WARNING!, the following 'head' element might be misplaced, i.e.\nthere could be a better place."
+            caption = etree.Element("head")
+            caption.text = text_region.text
+            xf.write(p)
+            xf.write(caption)
+        else:
+            caption = etree.SubElement(self.__scene, "div", type="notes")
+            message = "WARNING!, the element isn't placed correctly, it still needs a solution."
+            type_ = "type = " + text_region.type_name
+            content = text_region.text
+            p_text = [message, type_, content]
+            for text in p_text:
+                p = etree.SubElement(caption, "p")
+                p.text = text
+        return act_number
+
+    def _body_unknown(self, xf: "etree", text_region: "TextRegion", act_number: int) -> int:
+        if self.__prologue is not None:
+            unknown = etree.SubElement(self.__scene, "div", type="notes")
+        else:
+            unknown = etree.SubElement(self.__scene, "div", type="notes")
+        type_ = "type = " + text_region.type_name
+        content = text_region.text
+        p_list = [UNKNOWN, type_, content]
+        for e in p_list:
+            p = etree.SubElement(unknown, "p")
+            p.text = e
+        return act_number
 
     def concatenate_l_lines(self, text_region: "TextRegion") -> list:
         l_elements = []  
@@ -610,7 +782,8 @@ if __name__ == '__main__':
             else:
                 print('Metadata file already exists')
 
-            Conversion(str(folder_path / "*.xml")).create_tei(result_file)
+            if not Conversion(str(folder_path / "*.xml")).create_tei(result_file):
+                raise RuntimeError(f"no TEI was written to {result_file}")
 
             xml_file_path = result_file
             xml_content_verses = write_l_elements(xml_file_path)